@@ -17,15 +17,10 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
 import argparse
-from .controller import Controller
-from .camera import Camera
 from .utils import positive_int, dimensions
+from .daemon import RemoteCamera, RemoteController, default_address
 import tempfile
 import os
-import rawpy
-import cv2
-import exifread
-import numpy as np
 import json
 import sys
 
@@ -37,7 +32,8 @@ argument_parser = argparse.ArgumentParser(
 argument_parser.add_argument(
     '-p', '--controller-port',
     type=str,
-    help='Controller serial port. Will not move controller if not given.',
+    help='Controller serial port. Will not move controller if not given. '
+        'With --daemon, the daemon\'s controller is used and the value is ignored',
 )
 
 argument_parser.add_argument(
@@ -60,12 +56,35 @@ argument_parser.add_argument(
     help='Output filename, default is stdout'
 )
 
+argument_parser.add_argument(
+    '--daemon',
+    type=str,
+    nargs='?',
+    const=default_address,
+    help=f'Use the camera and controller held open by a running camoperator.daemon, default address is {default_address}',
+    metavar='ADDRESS'
+)
+
 def main():
     arguments = argument_parser.parse_args()
-    controller = Controller(arguments.controller_port) if arguments.controller_port else None
-    camera = Camera({
+
+    # Heavy imports are only needed once we actually process an image
+    import rawpy
+    import cv2
+    import exifread
+    import numpy as np
+
+    camera_config = {
         "autofocus": "On"
-    })
+    }
+    if arguments.daemon:
+        controller = RemoteController(arguments.daemon) if arguments.controller_port else None
+        camera = RemoteCamera(arguments.daemon, camera_config)
+    else:
+        from .controller import Controller
+        from .camera import Camera
+        controller = Controller(arguments.controller_port) if arguments.controller_port else None
+        camera = Camera(camera_config)
 
     # Reset to origin
     if controller:
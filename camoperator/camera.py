@@ -20,22 +20,25 @@ import gphoto2 as gp
 import os
 
 class Camera:
+    default_config = {
+        "imagequality": "NEF (Raw)",
+        "autofocus": "Off",
+        "capturemode": "Single Shot"
+    }
+
     def __init__(self, config={}):
         self.camera = gp.Camera()
         self.camera.init()
-
-        # Set up config
-        # TODO: make this modifiable
-        conf = self.camera.get_config()
-        for key, value in {
-            "imagequality": "NEF (Raw)",
-            "autofocus": "Off",
-            "capturemode": "Single Shot",
-            **config
-        }.items():
-            conf.get_child_by_name(key).set_value(str(value))
-        self.camera.set_config(conf)
-
+        self.configure(config)
+
+    def configure(self, config={}):
+        # Only read and write the widgets we care about, and skip those
+        # already holding the requested value
+        for key, value in {**self.default_config, **config}.items():
+            widget = self.camera.get_single_config(key)
+            if str(widget.get_value()) != str(value):
+                widget.set_value(str(value))
+                self.camera.set_single_config(key, widget)
     
     def capture(self):
         return self.camera.capture(gp.GP_CAPTURE_IMAGE)
@@ -45,5 +48,8 @@ class Camera:
         camera_file.save(destination)
         self.camera.file_delete(source.folder, source.name)
 
+    def delete(self, source):
+        self.camera.file_delete(source.folder, source.name)
+
     def close(self):
         self.camera.exit()
@@ -16,12 +16,13 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 
-import serial
-
 class Controller:
     max = 128000
 
     def __init__(self, port):
+        # Only needed once a controller is opened, not for Controller.max
+        import serial
+
         self.serial_port = serial.Serial(
             port,
             baudrate=9600,
@@ -0,0 +1,277 @@
+'''
+Copyright (C) 2024  Abdelrahman Abdelrahman
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+import argparse
+from multiprocessing.connection import Listener, Client
+from collections import namedtuple
+import threading
+import tempfile
+import json
+import os
+import logging
+
+# The socket lives in a directory only the current user can access, so no one
+# else can listen on it or connect to it
+runtime_directory = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(tempfile.gettempdir(), f'camoperator-{os.getuid()}')
+default_address = os.path.join(runtime_directory, 'camoperator.sock')
+
+CameraFile = namedtuple('CameraFile', ['folder', 'name'])
+
+camera_methods = set(["capture", "download"])
+controller_methods = set(["reset", "move_x", "move_y"])
+
+argument_parser = argparse.ArgumentParser(
+    prog='daemon',
+    description='Keeps the camera and controller open so that repeated camoperator '
+        'invocations can reuse them via --daemon'
+)
+
+argument_parser.add_argument(
+    '-p', '--controller-port',
+    type=str,
+    help='Controller serial port. Controller is not available to clients if not given.'
+)
+
+argument_parser.add_argument(
+    '-a', '--address',
+    type=str,
+    help=f'Socket address to listen on, default is {default_address}',
+    default=default_address
+)
+
+def check_address(address, create=False):
+    directory = os.path.dirname(os.path.abspath(address))
+    if create:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f'Daemon: {directory} must be owned by the current user and not accessible to others')
+
+# Messages are JSON so neither end has to trust the other with pickle
+def send(connection, message):
+    connection.send_bytes(json.dumps(message).encode())
+
+def recv(connection):
+    return json.loads(connection.recv_bytes())
+
+class Daemon:
+    def __init__(self, address, controller_port=None):
+        self.address = address
+        self.controller_port = controller_port
+        self.camera = None
+        self.controller = None
+        # Clients share the devices, so only one call may use each at a time
+        self.camera_lock = threading.Lock()
+        self.controller_lock = threading.Lock()
+        # Files returned by capture, so download gets back the camera's own object
+        self.captured = {}
+
+    # Callers hold the device's lock
+    def get_camera(self, config, reconfigure=False):
+        from .camera import Camera
+        if self.camera is None:
+            self.camera = Camera(config)
+        elif reconfigure:
+            self.camera.configure(config)
+        return self.camera
+
+    def get_controller(self):
+        from .controller import Controller
+        if self.controller is None:
+            if self.controller_port is None:
+                raise RuntimeError('Daemon: No controller port given')
+            self.controller = Controller(self.controller_port)
+        return self.controller
+
+    def drop_device(self, kind):
+        # The device is re-initialised for the next call, e.g. after the camera
+        # went to sleep or was power cycled
+        device = self.camera if kind == 'camera' else self.controller
+        logging.warning('Daemon: Dropping %s after an error', kind)
+        try:
+            device.close()
+        except Exception:
+            logging.exception('Daemon: Failed to close %s', kind)
+        if kind == 'camera':
+            self.camera = None
+            # Captures of the old session can no longer be downloaded
+            self.captured.clear()
+        else:
+            self.controller = None
+
+    def delete_orphans(self, keys):
+        # Images captured by a client that left before downloading them
+        with self.camera_lock:
+            for key in keys:
+                source = self.captured.pop(key, None)
+                if source is None or self.camera is None:
+                    continue
+                try:
+                    self.camera.delete(source)
+                except Exception:
+                    logging.exception('Daemon: Failed to delete orphaned capture %s', key)
+
+    def call(self, kind, config, lock, methods, method, args, captured):
+        if method not in methods:
+            raise RuntimeError(f'Daemon: Unknown method {method}')
+        with lock:
+            target = self.get_camera(config) if kind == 'camera' else self.get_controller()
+            if method == 'download':
+                key = tuple(args[0])
+                args = (self.captured.pop(key), *args[1:])
+                captured.discard(key)
+            try:
+                result = getattr(target, method)(*args)
+            except Exception:
+                self.drop_device(kind)
+                raise
+            if method == 'capture':
+                key = (result.folder, result.name)
+                self.captured[key] = result
+                captured.add(key)
+                result = list(key)
+        return result
+
+    def handle(self, connection):
+        captured = set()
+        with connection:
+            try:
+                kind, *args = recv(connection)
+            except (EOFError, OSError):
+                return
+            config = args[0] if args else {}
+
+            try:
+                if kind == 'camera':
+                    methods, lock = camera_methods, self.camera_lock
+                    with lock:
+                        try:
+                            self.get_camera(config, reconfigure=True)
+                        except Exception:
+                            if self.camera is not None:
+                                self.drop_device(kind)
+                            raise
+                elif kind == 'controller':
+                    methods, lock = controller_methods, self.controller_lock
+                    with lock:
+                        self.get_controller()
+                else:
+                    raise RuntimeError(f'Daemon: Unknown client type {kind}')
+                response = ['ok', None]
+            except Exception as e:
+                logging.exception('Daemon: Failed to set up client')
+                response = ['error', repr(e)]
+            try:
+                send(connection, response)
+            except (EOFError, OSError):
+                return
+            if response[0] != 'ok':
+                return
+
+            try:
+                while True:
+                    method, args = recv(connection)
+                    try:
+                        response = ['ok', self.call(kind, config, lock, methods, method, args, captured)]
+                    except Exception as e:
+                        logging.exception('Daemon: %s failed', method)
+                        response = ['error', repr(e)]
+                    send(connection, response)
+            except (EOFError, OSError):
+                # Client went away, including by a reset connection
+                pass
+            finally:
+                if captured:
+                    self.delete_orphans(captured)
+
+    def serve_forever(self):
+        check_address(self.address, create=True)
+        with Listener(self.address) as listener:
+            while True:
+                connection = listener.accept()
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def close(self):
+        if self.camera is not None:
+            with self.camera_lock:
+                self.camera.close()
+        if self.controller is not None:
+            with self.controller_lock:
+                self.controller.close()
+
+class RemoteDevice:
+    def __init__(self, address, *setup):
+        check_address(address)
+        self.connection = Client(address)
+        self.lock = threading.Lock()
+        self.request(*setup)
+
+    def request(self, *message):
+        with self.lock:
+            send(self.connection, message)
+            status, result = recv(self.connection)
+        if status != 'ok':
+            raise RuntimeError(f'Daemon: {result}')
+        return result
+
+    def call(self, method, *args):
+        return self.request(method, list(args))
+
+    def close(self):
+        self.connection.close()
+
+class RemoteCamera(RemoteDevice):
+    def __init__(self, address, config={}):
+        super().__init__(address, 'camera', config)
+
+    def capture(self):
+        return CameraFile(*self.call('capture'))
+
+    def download(self, source, destination):
+        self.call('download', list(source), os.path.abspath(destination))
+
+class RemoteController(RemoteDevice):
+    def __init__(self, address):
+        super().__init__(address, 'controller')
+
+    def reset(self):
+        self.call('reset')
+        self.x = 0
+        self.y = 0
+
+    def move_x(self, dx):
+        self.call('move_x', int(dx))
+        self.x += dx
+
+    def move_y(self, dy):
+        self.call('move_y', int(dy))
+        self.y += dy
+
+def main():
+    arguments = argument_parser.parse_args()
+    daemon = Daemon(arguments.address, arguments.controller_port)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
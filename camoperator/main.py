@@ -17,14 +17,16 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
 import argparse
-from .camera import Camera
 from .controller import Controller
 import os
 from itertools import cycle
-import numpy as np
-from tqdm import tqdm
 import threading
 from .utils import positive_int, dimensions
+from .daemon import RemoteCamera, RemoteController, default_address
+from .transcode import Transcoder, formats as transcode_formats
+from .workqueue import open_publisher
+from .storage import Storage, placements
+import time
 import json
 import logging
 
@@ -45,8 +47,7 @@ argument_parser.add_argument(
 argument_parser.add_argument(
     '-p', '--controller-port',
     type=str,
-    help='Controller serial port',
-    required=True
+    help='Controller serial port. Required unless --daemon is given'
 )
 
 argument_parser.add_argument(
@@ -104,30 +105,152 @@ argument_parser.add_argument(
     metavar='X,Y'
 )
 
+argument_parser.add_argument(
+    '--daemon',
+    type=str,
+    nargs='?',
+    const=default_address,
+    help=f'Use the camera and controller held open by a running camoperator.daemon, default address is {default_address}',
+    metavar='ADDRESS'
+)
+
+argument_parser.add_argument(
+    '--transcode',
+    choices=transcode_formats,
+    help='Transcode each captured image in the background to a compressed raw array (npz) or 16-bit TIFF (tiff) '
+        'with the metadata needed to develop it, deleting the original once verified'
+)
+
+argument_parser.add_argument(
+    '--transcode-workers',
+    type=positive_int,
+    help='Maximum number of transcoding processes, default is the number of CPUs'
+)
+
+argument_parser.add_argument(
+    '--publish',
+    type=str,
+    help='Publish a record for each finished tile to a work queue for camoperator.worker, '
+        'either spool:DIRECTORY or tcp://HOST:PORT',
+    metavar='QUEUE'
+)
+
+argument_parser.add_argument(
+    '--reclaim-after',
+    type=positive_int,
+    help='For tcp:// queues, seconds after which a tile handed to a worker that has not reported is handed out again. '
+        'Should be longer than processing a tile takes. Default is 3600',
+    default=3600
+)
+
+argument_parser.add_argument(
+    '--publish-timeout',
+    type=positive_int,
+    help='For tcp:// queues, seconds to wait after capture for workers while no tile gets processed. '
+        'Tiles left then are published to the spool queue in the unprocessed directory under the main directory. Default is 3600',
+    default=3600
+)
+
+argument_parser.add_argument(
+    '--extra-directory',
+    type=str,
+    action='append',
+    default=[],
+    help='Additional directory to save images to, can be given multiple times. '
+        'The directory each image is saved to is recorded in tiles.jsonl in the main directory',
+    metavar='DIRECTORY'
+)
+
+argument_parser.add_argument(
+    '--placement',
+    choices=placements,
+    help='spill fills each directory in order before moving to the next, stripe alternates between them. Default is spill',
+    default='spill'
+)
+
+argument_parser.add_argument(
+    '--min-free',
+    type=positive_int,
+    help='Free space in MB to keep in each directory on top of an image. Capture pauses until this is available. Default is 0',
+    default=0
+)
+
+argument_parser.add_argument(
+    '--no-space-check',
+    action='store_true',
+    help='Do not check that the remaining images fit in the free space before capturing'
+)
+
+argument_parser.add_argument(
+    '--tile-size',
+    type=positive_int,
+    help='Expected image size in MB for checking free space before capturing. '
+        'Default is the largest existing image, or the first captured image'
+)
+
+argument_parser.add_argument(
+    '--recapture',
+    type=argparse.FileType('r'),
+    help='Only capture the images in a recapture plan written by camoperator.verify --plan',
+    metavar='PLAN'
+)
+
 def get_steps(min, max, divisions):
+    import numpy as np
     positions = np.round(np.linspace(min, max, divisions))
     return (positions[1:]-positions[:-1]).astype(int)
 
+def tile_ready(x, y, filename):
+    if work_queue is not None:
+        work_queue.publish({
+            "x": int(x),
+            "y": int(y),
+            "filename": os.path.abspath(filename)
+        })
+
 class DownloadThread(threading.Thread):
-    def __init__(self, camera, source, destination, progress):
+    def __init__(self, camera, source, destination, progress, x, y):
         threading.Thread.__init__(self)
         self.camera = camera
         self.source = source
         self.destination = destination
         self.progress = progress
+        self.x = x
+        self.y = y
     
     def run(self):
         self.camera.download(self.source, self.destination)
+        storage.tile_written(self.x, self.y, self.destination)
+        if transcoder is not None:
+            transcoder.submit(self.destination, lambda filename: tile_ready(self.x, self.y, filename))
+        else:
+            tile_ready(self.x, self.y, self.destination)
         self.progress.update(1)
 
 def get_filename(directory, x, y):
     return os.path.join(directory, f"{x}-{y}.nef")
 
 download_thread = None
-def capture_xy(camera, directory, x, y, progress):
+transcoder = None
+work_queue = None
+storage = None
+recapture_tiles = None
+def capture_xy(camera, x, y, progress):
     global download_thread
+    if recapture_tiles is not None and (x, y) not in recapture_tiles:
+        progress.update(1)
+        return
+
     if download_thread != None:
+        wait_start = time.monotonic()
         download_thread.join()
+        if transcoder is not None:
+            transcoder.report_wait(time.monotonic() - wait_start)
+
+    if not storage.checked and storage.tile_size:
+        storage.preflight(len(recapture_tiles) if recapture_tiles is not None else progress.total - progress.n)
+    directory = storage.directory_for(x, y,
+        lambda: progress.set_description(f'Waiting for free space. Current ({x}, {y})'))
 
     logging.info('Capturing image for coordinates (%d, %d)', x, y)
 
@@ -137,20 +260,58 @@ def capture_xy(camera, directory, x, y, progress):
         camera,
         capture_file,
         get_filename(directory, x, y),
-        progress
+        progress,
+        x, y
     )
     download_thread.start()
 
-def capture_x_axis(camera, directory, y, start_index, index_and_steps, controller, progress):
-    capture_xy(camera, directory, start_index, y, progress)
+def capture_x_axis(camera, y, start_index, index_and_steps, controller, progress):
+    capture_xy(camera, start_index, y, progress)
 
     for x, x_step in index_and_steps:
         controller.move_x(x_step)
-        capture_xy(camera, directory, x, y, progress)
+        capture_xy(camera, x, y, progress)
 
 def main():
+    global transcoder, work_queue, storage, recapture_tiles
     arguments = argument_parser.parse_args()
-    controller = Controller(arguments.controller_port)
+    if arguments.controller_port is None and arguments.daemon is None:
+        argument_parser.error('the following arguments are required: -p/--controller-port')
+
+    recapture_tiles = None
+    if arguments.recapture is not None:
+        plan = json.load(arguments.recapture)
+        if (plan["horizontal_images"], plan["vertical_images"]) != (arguments.horizontal_images, arguments.vertical_images):
+            argument_parser.error(f'recapture plan is for {plan["horizontal_images"]}x{plan["vertical_images"]} images')
+        if plan["resume"] is None:
+            logging.info('Recapture plan is empty, nothing to capture')
+            return
+        recapture_tiles = set(tuple(tile) for tile in plan["tiles"])
+        if arguments.resume is None:
+            arguments.resume = tuple(plan["resume"])
+
+    resume_x, resume_y = arguments.resume or (arguments.horizontal_images-1, 0)
+    initial = arguments.horizontal_images*resume_y + (arguments.horizontal_images - resume_x - 1 if resume_y%2 == 0 else resume_x)
+
+    from tqdm import tqdm
+
+    # Transcoding shrinks images during the run, so running short is only a warning then.
+    # Workers are not counted on, whatever they do with the images is up to their command
+    storage = Storage([arguments.directory, *arguments.extra_directory], arguments.placement,
+        arguments.min_free*1024*1024, arguments.tile_size and arguments.tile_size*1024*1024,
+        strict=not arguments.transcode,
+        in_flight=lambda: transcoder.running if transcoder is not None else 0)
+    if arguments.no_space_check:
+        storage.checked = True
+    elif storage.tile_size:
+        # Otherwise checked once the first image shows how large they are
+        storage.preflight(len(recapture_tiles) if recapture_tiles is not None
+            else arguments.horizontal_images*arguments.vertical_images - initial)
+    transcoder = Transcoder(arguments.transcode, arguments.transcode_workers) if arguments.transcode else None
+    work_queue = open_publisher(arguments.publish, arguments.reclaim_after, arguments.publish_timeout,
+        os.path.join(arguments.directory, 'unprocessed')) if arguments.publish else None
+
+    controller = RemoteController(arguments.daemon) if arguments.daemon else Controller(arguments.controller_port)
 
     # Get camera config if any
     camera_config = {}
@@ -163,11 +324,17 @@ def main():
         except FileNotFoundError:
             pass
 
-    camera = Camera(dict(
+    camera_config = dict(
         (key, camera_config[key])
         for key in camera_config
         if key in set(["f-number", "iso", "shutterspeed", "whitebalance"])
-    ))
+    )
+    if arguments.daemon:
+        camera = RemoteCamera(arguments.daemon, camera_config)
+    else:
+        # Loads libgphoto2, which the daemon already has open
+        from .camera import Camera
+        camera = Camera(camera_config)
     
     controller.reset()
 
@@ -180,29 +347,26 @@ def main():
     y_steps = get_steps(arguments.min_y, arguments.max_y, arguments.vertical_images)
     x_steps = get_steps(arguments.min_x, arguments.max_x, arguments.horizontal_images)
 
-    resume_x, resume_y = arguments.horizontal_images-1, 0
-    if arguments.resume:
-        resume_x, resume_y = arguments.resume
-        if resume_y > 0:
-            controller.move_y(y_steps[:resume_y].sum())
-        if resume_x < arguments.horizontal_images-1:
-            controller.move_x(x_steps[:(arguments.horizontal_images-resume_x-1)].sum())
+    if resume_y > 0:
+        controller.move_y(y_steps[:resume_y].sum())
+    if resume_x < arguments.horizontal_images-1:
+        controller.move_x(x_steps[:(arguments.horizontal_images-resume_x-1)].sum())
 
     progress = tqdm(desc='Capturing images.', total=(arguments.horizontal_images)*(arguments.vertical_images),
-        initial=arguments.horizontal_images*resume_y + (arguments.horizontal_images - resume_x - 1 if resume_y%2 == 0 else resume_x)
+        initial=initial
     )
 
     left_steps = list(zip(range(arguments.horizontal_images-2, -1, -1), x_steps))
     right_steps = list(enumerate(reversed(-x_steps), start=1))
 
-    capture_x_axis(camera, arguments.directory, resume_y,
+    capture_x_axis(camera, resume_y,
         resume_x,
         left_steps[(arguments.horizontal_images-resume_x-1):] if resume_y%2 == 0 else right_steps[resume_x:],
         controller, progress)
     for y, y_step in enumerate(y_steps[resume_y:], start=resume_y+1):
         even_y = y%2 == 0
         controller.move_y(y_step)
-        capture_x_axis(camera, arguments.directory, y,
+        capture_x_axis(camera, y,
             arguments.horizontal_images-1 if even_y else 0,
             left_steps if even_y else right_steps,
             controller,
@@ -212,6 +376,18 @@ def main():
     download_thread.join()
     camera.close()
     controller.close()
+
+    failures = []
+    if transcoder is not None:
+        progress.set_description('Waiting for transcoding to finish')
+        failures = transcoder.close()
+
+    if work_queue is not None:
+        progress.set_description('Waiting for workers to finish')
+        work_queue.finish()
+
+    if failures:
+        raise RuntimeError(f'Transcoder: Failed to transcode {", ".join(filename for filename, _ in failures)}')
         
         
 
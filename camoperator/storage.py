@@ -0,0 +1,114 @@
+'''
+Copyright (C) 2024  Abdelrahman Abdelrahman
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+import shutil
+import json
+import os
+import re
+import time
+import logging
+
+placements = ["spill", "stripe"]
+
+tile_re = re.compile("(\\d+)-(\\d+)\\.(.*)")
+
+tile_map_filename = 'tiles.jsonl'
+
+def read_tile_map(directory):
+    tile_map = {}
+    try:
+        with open(os.path.join(directory, tile_map_filename)) as tile_map_file:
+            for line in tile_map_file:
+                entry = json.loads(line)
+                tile_map[(entry["x"], entry["y"])] = entry["directory"]
+    except FileNotFoundError:
+        pass
+    return tile_map
+
+class Storage:
+    check_interval = 5
+
+    # in_flight returns how many images are being written besides the next
+    # tile, e.g. by running transcodes, which keep the original until done
+    def __init__(self, directories, placement="spill", min_free=0, tile_size=None, strict=True, in_flight=None):
+        self.directories = directories
+        self.placement = placement
+        self.min_free = min_free
+        self.strict = strict
+        self.in_flight = in_flight
+        self.index = 0
+        self.checked = False
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+        self.tile_size = tile_size or self.largest_tile()
+
+    def largest_tile(self):
+        sizes = [
+            entry.stat().st_size
+            for directory in self.directories
+            for entry in os.scandir(directory)
+            if tile_re.fullmatch(entry.name)
+        ]
+        return max(sizes, default=None)
+
+    def available(self, directory):
+        return shutil.disk_usage(directory).free - self.min_free
+
+    def preflight(self, tiles):
+        self.checked = True
+        # Directories on the same volume share their free space
+        volumes = {}
+        for directory in self.directories:
+            volumes[os.stat(directory).st_dev] = max(0, self.available(directory))
+        projected = tiles * self.tile_size
+        available = sum(volumes.values())
+        logging.info('Storage: %d tiles need about %d bytes, %d bytes available', tiles, projected, available)
+        if projected > available:
+            message = (f'Storage: {tiles} tiles of about {self.tile_size} bytes need {projected} bytes, '
+                f'only {available} bytes are available in {", ".join(self.directories)}')
+            if self.strict:
+                raise RuntimeError(message)
+            logging.warning(message)
+
+    def has_room(self, directory):
+        images = 1 + (self.in_flight() if self.in_flight is not None else 0)
+        return self.available(directory) >= (self.tile_size or 0) * images
+
+    def directory_for(self, x, y, on_pause=None):
+        # Pause until space frees up, e.g. by transcoding or moving tiles away
+        while True:
+            if self.placement == "stripe":
+                candidates = self.directories[self.index:] + self.directories[:self.index]
+            else:
+                candidates = self.directories
+            for directory in candidates:
+                if self.has_room(directory):
+                    self.index = (self.directories.index(directory) + 1) % len(self.directories)
+                    return directory
+            logging.warning('Storage: No room for tile (%d, %d), waiting for free space', x, y)
+            if on_pause is not None:
+                on_pause()
+            time.sleep(self.check_interval)
+
+    def tile_written(self, x, y, filename):
+        self.tile_size = max(self.tile_size or 0, os.path.getsize(filename))
+        # Once written, the map has to follow every recapture, even one into a single directory
+        tile_map_path = os.path.join(self.directories[0], tile_map_filename)
+        if len(self.directories) > 1 or os.path.exists(tile_map_path):
+            with open(tile_map_path, 'a') as tile_map_file:
+                tile_map_file.write(json.dumps({"x": int(x), "y": int(y), "directory": os.path.abspath(os.path.dirname(filename))}) + '\n')
@@ -0,0 +1,216 @@
+'''
+Copyright (C) 2024  Abdelrahman Abdelrahman
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from .utils import process_context
+import threading
+import json
+import os
+import logging
+
+formats = ["npz", "tiff"]
+
+def lower_priority():
+    # Keep the capture loop ahead of the transcoders when competing for CPU
+    os.nice(10)
+
+def exif_value(value):
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, (list, tuple)):
+        return [exif_value(item) for item in value]
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    # Ratios, which may have a zero denominator
+    return [value.numerator, value.denominator]
+
+def read_exif(filename):
+    import exifread
+
+    with open(filename, 'rb') as raw_file:
+        tags = exifread.process_file(raw_file, details=True)
+    # Embedded thumbnails are plain bytes rather than tags and can be rendered again from the raw data
+    return dict(
+        (key, {"type": tag.field_type, "values": exif_value(tag.values), "printable": tag.printable})
+        for key, tag in tags.items()
+        if hasattr(tag, "values")
+    )
+
+def text_array(text):
+    import numpy as np
+    return np.frombuffer(text.encode(), dtype=np.uint8)
+
+def transcode(filename, format):
+    import rawpy
+    import numpy as np
+
+    with rawpy.imread(filename) as raw_img:
+        raw_image = raw_img.raw_image.copy()
+        arrays = {
+            "black_level_per_channel": np.array(raw_img.black_level_per_channel),
+            "white_level": np.array(raw_img.white_level),
+            "raw_pattern": raw_img.raw_pattern.copy(),
+            "camera_whitebalance": np.array(raw_img.camera_whitebalance),
+            "daylight_whitebalance": np.array(raw_img.daylight_whitebalance),
+            "rgb_xyz_matrix": raw_img.rgb_xyz_matrix.copy(),
+            "color_matrix": raw_img.color_matrix.copy(),
+            "tone_curve": raw_img.tone_curve.copy()
+        }
+        # Margins, visible area and flip, raw_image still includes the margins
+        sizes = raw_img.sizes._asdict()
+        color_desc = raw_img.color_desc.decode('ascii')
+    exif = read_exif(filename)
+
+    base, _ = os.path.splitext(filename)
+    output = f"{base}.{format}"
+    temp_output = f"{base}.tmp.{format}"
+
+    if format == "npz":
+        metadata = {
+            **arrays,
+            "color_desc": text_array(color_desc),
+            "sizes": text_array(json.dumps(sizes)),
+            "exif": text_array(json.dumps(exif))
+        }
+        np.savez_compressed(temp_output, raw_image=raw_image, **metadata)
+        with np.load(temp_output) as archive:
+            verified = (
+                set(archive.files) == set(["raw_image", *metadata])
+                and np.array_equal(archive["raw_image"], raw_image)
+                and all(np.array_equal(archive[key], value) for key, value in metadata.items())
+            )
+    elif format == "tiff":
+        import cv2
+        # 5 is LZW, which is lossless
+        cv2.imwrite(temp_output, raw_image, [cv2.IMWRITE_TIFF_COMPRESSION, 5])
+        verified = np.array_equal(cv2.imread(temp_output, cv2.IMREAD_UNCHANGED), raw_image)
+
+        # TIFF has nowhere for the metadata needed to develop the raw data
+        sidecar = dict((key, value.tolist()) for key, value in arrays.items())
+        sidecar.update(color_desc=color_desc, sizes=sizes, exif=exif)
+        # Compared after a round trip so tuples are lists on both sides
+        expected = json.loads(json.dumps(sidecar))
+        with open(f"{temp_output}.json", "w") as sidecar_file:
+            json.dump(sidecar, sidecar_file)
+        with open(f"{temp_output}.json") as sidecar_file:
+            verified = verified and json.load(sidecar_file) == expected
+    else:
+        raise ValueError(f"Unknown transcode format {format}")
+
+    if not verified:
+        os.remove(temp_output)
+        if format == "tiff":
+            os.remove(f"{temp_output}.json")
+        raise RuntimeError(f"Transcoder: {temp_output} does not match {filename}")
+
+    if format == "tiff":
+        os.replace(f"{temp_output}.json", f"{output}.json")
+    os.replace(temp_output, output)
+    os.remove(filename)
+    return output
+
+class Transcoder:
+    # Capture always waits some time for the previous download. Waits are
+    # averaged over this many images and compared to the average of the
+    # first ones, so only slowdown caused by the transcoders counts
+    samples = 5
+    # Allowed slowdown over the baseline, as a fraction and in seconds
+    stall_tolerance = 0.25
+    stall_slack = 0.05
+
+    def __init__(self, format, max_workers=None):
+        self.format = format
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.workers = 1
+        self.waits = deque(maxlen=self.samples)
+        self.baseline = None
+        self.executor = ProcessPoolExecutor(self.max_workers, mp_context=process_context(), initializer=lower_priority)
+        self.pending = deque()
+        self.running = 0
+        self.failures = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, filename, callback=None):
+        with self.condition:
+            self.pending.append((filename, callback))
+            self.condition.notify_all()
+
+    def report_wait(self, seconds):
+        with self.condition:
+            self.waits.append(seconds)
+            if len(self.waits) < self.samples:
+                return
+            average = sum(self.waits) / len(self.waits)
+            if self.baseline is None:
+                self.baseline = average
+                logging.debug('Transcoder: Baseline download wait is %fs', self.baseline)
+                return
+            self.baseline = min(self.baseline, average)
+
+            if average > self.baseline * (1 + self.stall_tolerance) + self.stall_slack:
+                self.workers = max(1, self.workers // 2)
+            elif self.pending and self.running >= self.workers:
+                self.workers = min(self.max_workers, self.workers + 1)
+            else:
+                return
+            # Judge the new number of workers on its own waits
+            self.waits.clear()
+            logging.debug('Transcoder: Using %d workers', self.workers)
+            self.condition.notify_all()
+
+    def dispatch(self):
+        with self.condition:
+            while True:
+                while (not self.pending or self.running >= self.workers) and not (self.closed and not self.pending):
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                filename, callback = self.pending.popleft()
+                self.running += 1
+                future = self.executor.submit(transcode, filename, self.format)
+                future.add_done_callback(lambda future, filename=filename, callback=callback: self.done(filename, callback, future))
+
+    def done(self, filename, callback, future):
+        error = future.exception()
+        with self.condition:
+            self.running -= 1
+            if error is not None:
+                self.failures.append((filename, error))
+            self.condition.notify_all()
+
+        # Outside the lock, so a slow callback does not hold up capture in report_wait
+        if error is not None:
+            logging.error('Transcoder: Failed to transcode %s: %r', filename, error)
+        else:
+            logging.info('Transcoder: Transcoded %s to %s', filename, future.result())
+            if callback is not None:
+                callback(future.result())
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            # Capture is over, nothing left to starve
+            self.workers = self.max_workers
+            self.condition.notify_all()
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+        return self.failures
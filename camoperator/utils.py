@@ -16,6 +16,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 
+import multiprocessing
+
 def positive_int(arg):
     n = int(arg)
     if n < 0:
@@ -25,3 +27,10 @@ def positive_int(arg):
 def dimensions(arg):
     x, y = arg.split(',')
     return (positive_int(x), positive_int(y))
+
+def process_context():
+    # Forking copies the parent's threads' locks and open devices, e.g. the
+    # camera session and the download thread, into the worker processes
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
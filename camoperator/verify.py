@@ -0,0 +1,232 @@
+'''
+Copyright (C) 2024  Abdelrahman Abdelrahman
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .storage import tile_re, read_tile_map
+from .utils import positive_int, process_context
+import statistics
+import json
+import os
+import sys
+
+# Extensions written by capture and transcoding, and the magic bytes they start with
+headers = {
+    "nef": [b"II*\x00", b"MM\x00*"],
+    "tiff": [b"II*\x00", b"MM\x00*"],
+    "npz": [b"PK\x03\x04"]
+}
+
+argument_parser = argparse.ArgumentParser(
+    prog='verify',
+    description='Checks captured images against the grid and writes a plan to recapture the bad or missing ones'
+)
+
+argument_parser.add_argument(
+    'directory',
+    type=str,
+    help='Directory images were saved to'
+)
+
+argument_parser.add_argument(
+    '-X', '--horizontal-images',
+    type=positive_int,
+    help='Number of horizontal images',
+    required=True
+)
+
+argument_parser.add_argument(
+    '-Y', '--vertical-images',
+    type=positive_int,
+    help='Number of vertical images',
+    required=True
+)
+
+argument_parser.add_argument(
+    '--extra-directory',
+    type=str,
+    action='append',
+    default=[],
+    help='Additional directory images were saved to, can be given multiple times. '
+        'Directories recorded in tiles.jsonl are always checked',
+    metavar='DIRECTORY'
+)
+
+argument_parser.add_argument(
+    '--min-size',
+    type=positive_int,
+    help='Minimum image size in bytes. Default is half the median size of images of the same type'
+)
+
+argument_parser.add_argument(
+    '--decode',
+    action='store_true',
+    help='Fully decode every image. Much slower, but catches corruption past the header'
+)
+
+argument_parser.add_argument(
+    '-j', '--jobs',
+    type=positive_int,
+    help='Number of images to check at the same time. Default depends on the number of CPUs'
+)
+
+argument_parser.add_argument(
+    '-o', '--output',
+    type=argparse.FileType(mode='w'),
+    help='Output filename for a JSON line per bad or missing image, default is stdout'
+)
+
+argument_parser.add_argument(
+    '--plan',
+    type=str,
+    help='Filename to write a recapture plan to, which can be given to camoperator.main --recapture'
+)
+
+def build_index(directories):
+    index = {}
+    for directory in directories:
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                match = tile_re.fullmatch(entry.name)
+                if match and match.group(3).lower() in headers:
+                    x, y = int(match.group(1)), int(match.group(2))
+                    info = entry.stat()
+                    index.setdefault((x, y), []).append((entry.path, match.group(3).lower(), info.st_size, info.st_mtime_ns))
+    return index
+
+def check_header(filename, extension):
+    with open(filename, 'rb') as tile_file:
+        header = tile_file.read(4)
+    if header not in headers[extension]:
+        return f"Invalid header {header!r}"
+
+def decode(filename, extension):
+    try:
+        if extension == "nef":
+            import rawpy
+            with rawpy.imread(filename) as raw_img:
+                raw_img.raw_image.sum()
+        elif extension == "npz":
+            import numpy as np
+            with np.load(filename) as archive:
+                archive["raw_image"].sum()
+        else:
+            import cv2
+            if cv2.imread(filename, cv2.IMREAD_UNCHANGED) is None:
+                return "Could not decode"
+    except Exception as e:
+        return f"Could not decode: {e!r}"
+
+def check_file(args):
+    filename, extension, size, min_size, full_decode = args
+    if size < min_size:
+        return "small", f"Size {size} is less than {min_size}"
+    error = check_header(filename, extension)
+    if error:
+        return "invalid", error
+    if full_decode:
+        error = decode(filename, extension)
+        if error:
+            return "undecodable", error
+    return "ok", None
+
+def capture_order(horizontal_images, vertical_images):
+    # Same order camoperator.main captures in
+    for y in range(vertical_images):
+        xs = range(horizontal_images-1, -1, -1) if y%2 == 0 else range(horizontal_images)
+        for x in xs:
+            yield x, y
+
+# Yields a dict for each bad or missing image as soon as it is checked
+def verify(directories, horizontal_images, vertical_images, min_size=None, full_decode=False, jobs=None, tile_map={}):
+    index = build_index(directories)
+
+    if min_size is None:
+        sizes = {}
+        for files in index.values():
+            for _, extension, size, _ in files:
+                sizes.setdefault(extension, []).append(size)
+        min_sizes = dict((extension, statistics.median(values)/2) for extension, values in sizes.items())
+    else:
+        min_sizes = dict((extension, min_size) for extension in headers)
+
+    tasks = []
+    for x, y in capture_order(horizontal_images, vertical_images):
+        files = index.get((x, y))
+        if files and (x, y) in tile_map:
+            # Only the latest copy counts, a recaptured image may be in another directory than the bad one
+            directory = os.path.abspath(tile_map[(x, y)])
+            files = [file for file in files if os.path.dirname(os.path.abspath(file[0])) == directory]
+        if not files:
+            yield {"x": x, "y": y, "status": "missing"}
+            continue
+        # Older files are left over from before a recapture or a transcode, e.g. a bad .npz next to a recaptured .nef
+        filename, extension, size, _ = max(files, key=lambda file: file[3])
+        tasks.append((filename, extension, size, min_sizes[extension], full_decode))
+
+    # Decoding is CPU bound, header checks are IO bound
+    executor = ProcessPoolExecutor(jobs, mp_context=process_context()) if full_decode else ThreadPoolExecutor(jobs or min(32, (os.cpu_count() or 1)*4))
+    with executor:
+        for task, (status, detail) in zip(tasks, executor.map(check_file, tasks, chunksize=64 if full_decode else 1)):
+            if status != "ok":
+                filename = task[0]
+                match = tile_re.fullmatch(os.path.basename(filename))
+                yield {"x": int(match.group(1)), "y": int(match.group(2)), "status": status, "filename": filename, "detail": detail}
+
+def recapture_plan(problems, horizontal_images, vertical_images):
+    tiles = set((problem["x"], problem["y"]) for problem in problems)
+    order = [tile for tile in capture_order(horizontal_images, vertical_images) if tile in tiles]
+    return {
+        "horizontal_images": horizontal_images,
+        "vertical_images": vertical_images,
+        "resume": list(order[0]) if order else None,
+        "tiles": [list(tile) for tile in order]
+    }
+
+def main():
+    arguments = argument_parser.parse_args()
+    tile_map = read_tile_map(arguments.directory)
+    directories = []
+    for directory in [arguments.directory, *arguments.extra_directory, *tile_map.values()]:
+        if os.path.abspath(directory) not in directories:
+            directories.append(os.path.abspath(directory))
+
+    output_buffer = arguments.output or sys.stdout
+    problems = []
+    for problem in verify(directories, arguments.horizontal_images, arguments.vertical_images,
+        arguments.min_size, arguments.decode, arguments.jobs, tile_map):
+        problems.append(problem)
+        output_buffer.write(json.dumps(problem) + '\n')
+        output_buffer.flush()
+
+    print(f'{len(problems)} problems found in {arguments.horizontal_images*arguments.vertical_images} images', file=sys.stderr)
+
+    if arguments.plan:
+        with open(arguments.plan, 'w') as plan_file:
+            json.dump(recapture_plan(problems, arguments.horizontal_images, arguments.vertical_images), plan_file)
+
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+'''
+Copyright (C) 2024  Abdelrahman Abdelrahman
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+import argparse
+from .workqueue import open_consumer
+from .utils import positive_int
+import subprocess
+import threading
+import shlex
+import socket
+import logging
+
+argument_parser = argparse.ArgumentParser(
+    prog='worker',
+    description='Processes tiles published by a running or finished capture as they become ready'
+)
+
+argument_parser.add_argument(
+    'queue',
+    type=str,
+    help='Work queue to consume from, either spool:DIRECTORY or tcp://HOST:PORT'
+)
+
+argument_parser.add_argument(
+    '-c', '--command',
+    type=str,
+    help='Command to run for each tile. {filename}, {x} and {y} are replaced by the tile\'s values',
+    required=True
+)
+
+argument_parser.add_argument(
+    '-j', '--jobs',
+    type=positive_int,
+    help='Number of tiles to process at the same time',
+    default=1
+)
+
+argument_parser.add_argument(
+    '--reclaim-after',
+    type=positive_int,
+    help='For spool queues, seconds after which a tile claimed by a worker that has not reported is processed again. '
+        'Should be longer than processing a tile takes. Default is 3600',
+    default=3600
+)
+
+def process(command, record):
+    try:
+        arguments = [argument.format(**record) for argument in shlex.split(command)]
+        logging.info('Worker: Processing tile (%d, %d) with %s', record["x"], record["y"], arguments)
+        completed = subprocess.run(arguments, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except Exception as e:
+        # The command could not be started, e.g. a missing executable
+        logging.exception('Worker: Failed to run command for tile (%d, %d)', record["x"], record["y"])
+        return {
+            "returncode": 127,
+            "host": socket.gethostname(),
+            "output": repr(e)
+        }
+    return {
+        "returncode": completed.returncode,
+        "host": socket.gethostname(),
+        # Only keep the end of the output, it is usually where errors are
+        "output": completed.stdout[-4096:]
+    }
+
+def consume(spec, command, reclaim_after=None):
+    queue = open_consumer(spec, reclaim_after)
+    try:
+        while True:
+            record = queue.get()
+            if record is None:
+                return
+            queue.report(record, process(command, record))
+    finally:
+        queue.close()
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arguments = argument_parser.parse_args()
+
+    # Each job has its own queue connection so a blocked get does not hold up reports
+    jobs = [
+        threading.Thread(target=consume, args=(arguments.queue, arguments.command, arguments.reclaim_after))
+        for _ in range(max(arguments.jobs, 1))
+    ]
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+'''
+Copyright (C) 2024  Abdelrahman Abdelrahman
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+from multiprocessing.connection import Listener, Client
+from collections import deque
+import threading
+import json
+import os
+import socket
+import time
+import logging
+
+# Tile records stored as JSON files in a directory, usually on a shared
+# filesystem. Every state change is a rename, so records are never seen
+# half written and only one worker can claim each.
+class SpoolQueue:
+    states = ["tmp", "ready", "claimed", "done", "failed"]
+    poll_interval = 1
+
+    def __init__(self, directory, reclaim_after=None):
+        self.directory = directory
+        self.reclaim_after = reclaim_after
+        for state in self.states:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def path(self, state, name):
+        return os.path.join(self.directory, state, name)
+
+    def write(self, state, name, data):
+        temp_path = self.path("tmp", f"{name}.{socket.gethostname()}.{os.getpid()}")
+        with open(temp_path, "w") as temp_file:
+            json.dump(data, temp_file)
+        os.rename(temp_path, self.path(state, name))
+
+    def publish(self, record):
+        self.write("ready", f"{time.time_ns()}-{record['x']}-{record['y']}.json", record)
+
+    def get(self):
+        while True:
+            closed = os.path.exists(os.path.join(self.directory, "closed"))
+            for name in sorted(os.listdir(os.path.join(self.directory, "ready"))):
+                try:
+                    os.rename(self.path("ready", name), self.path("claimed", name))
+                except FileNotFoundError:
+                    # Claimed by another worker
+                    continue
+                with open(self.path("claimed", name)) as record_file:
+                    return {**json.load(record_file), "id": name}
+            if self.reclaim_after is not None and self.reclaim(self.reclaim_after):
+                continue
+            if closed:
+                return None
+            time.sleep(self.poll_interval)
+
+    def reclaim(self, max_age):
+        # Puts back records claimed by workers that stopped without reporting.
+        # The rename into claimed updates ctime, so that is when it was claimed
+        reclaimed = 0
+        now = time.time()
+        for name in os.listdir(os.path.join(self.directory, "claimed")):
+            try:
+                info = os.stat(self.path("claimed", name))
+                if now - max(info.st_mtime, info.st_ctime) < max_age:
+                    continue
+                os.rename(self.path("claimed", name), self.path("ready", name))
+            except FileNotFoundError:
+                # Reported or reclaimed by another worker
+                continue
+            logging.warning('Work queue: Reclaimed %s', name)
+            reclaimed += 1
+        return reclaimed
+
+    def report(self, record, result):
+        self.write("done" if result["returncode"] == 0 else "failed", record["id"], {**record, "result": result})
+        try:
+            os.remove(self.path("claimed", record["id"]))
+        except FileNotFoundError:
+            # Reclaimed while it was being processed
+            pass
+
+    def reopen(self):
+        try:
+            os.remove(os.path.join(self.directory, "closed"))
+        except FileNotFoundError:
+            pass
+
+    def finish(self):
+        with open(os.path.join(self.directory, "closed"), "w"):
+            pass
+
+    def close(self):
+        # Nothing is held open between calls
+        pass
+
+# Serves tile records to workers over a socket from the capture process.
+# Records handed to a worker that disconnects before reporting, or that has
+# not reported after reclaim_after seconds, are queued again. Messages are
+# JSON so workers need not be trusted with pickle.
+class SocketQueue:
+    poll_interval = 1
+
+    def __init__(self, address, reclaim_after=None, finish_timeout=None, fallback=None):
+        self.listener = Listener(address)
+        self.reclaim_after = reclaim_after
+        self.finish_timeout = finish_timeout
+        self.fallback = fallback
+        self.records = deque()
+        # Records handed to workers by id, with the connection and time they were claimed on
+        self.claims = {}
+        self.outstanding = 0
+        self.progress = time.monotonic()
+        self.closed = False
+        self.condition = threading.Condition()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def reclaim(self):
+        # Callers hold the condition
+        if self.reclaim_after is None:
+            return
+        now = time.monotonic()
+        for record, _, claimed_at in list(self.claims.values()):
+            if now - claimed_at < self.reclaim_after:
+                continue
+            del self.claims[record["id"]]
+            self.records.appendleft(record)
+            logging.warning('Work queue: Reclaimed tile (%d, %d) from a worker that has not reported', record["x"], record["y"])
+
+    def next(self, connection):
+        with self.condition:
+            while True:
+                self.reclaim()
+                if self.records or self.closed:
+                    break
+                self.condition.wait(self.poll_interval)
+            if not self.records:
+                return None
+            record = self.records.popleft()
+            self.claims[record["id"]] = (record, connection, time.monotonic())
+            return record
+
+    def complete(self, record, result):
+        with self.condition:
+            # The first report counts, the record may have been reclaimed and handed to another worker since
+            if self.claims.pop(record["id"], None) is None:
+                queued = [queued for queued in self.records if queued["id"] == record["id"]]
+                if not queued:
+                    logging.warning('Work queue: Ignoring another report for tile (%d, %d) from %s',
+                        record["x"], record["y"], result["host"])
+                    return
+                self.records.remove(queued[0])
+            self.outstanding -= 1
+            self.progress = time.monotonic()
+            self.condition.notify_all()
+        log = logging.info if result["returncode"] == 0 else logging.error
+        log('Work queue: Tile (%d, %d) processed by %s with return code %d',
+            record["x"], record["y"], result["host"], result["returncode"])
+
+    def release(self, connection):
+        with self.condition:
+            for record, owner, _ in list(self.claims.values()):
+                if owner is connection:
+                    del self.claims[record["id"]]
+                    self.records.appendleft(record)
+            self.condition.notify_all()
+
+    def handle(self, connection):
+        with connection:
+            try:
+                while True:
+                    request = json.loads(connection.recv_bytes())
+                    if request["type"] == "get":
+                        connection.send_bytes(json.dumps(self.next(connection)).encode())
+                    elif request["type"] == "report":
+                        self.complete(request["record"], request["result"])
+            except (EOFError, OSError):
+                pass
+            finally:
+                self.release(connection)
+
+    def publish(self, record):
+        with self.condition:
+            self.records.append({**record, "id": f"{record['x']}-{record['y']}"})
+            self.outstanding += 1
+            self.condition.notify_all()
+
+    def finish(self):
+        # Keep serving until every record has been processed, or no record has
+        # been for finish_timeout seconds, e.g. because no worker is connected
+        with self.condition:
+            self.progress = time.monotonic()
+            while self.outstanding > 0:
+                if self.finish_timeout is not None and time.monotonic() - self.progress >= self.finish_timeout:
+                    break
+                self.reclaim()
+                self.condition.wait(self.poll_interval)
+            unprocessed = [*self.records, *(record for record, _, _ in self.claims.values())]
+            self.records.clear()
+            self.claims.clear()
+            self.closed = True
+            self.condition.notify_all()
+        self.listener.close()
+
+        if unprocessed:
+            logging.warning('Work queue: Gave up waiting for workers with %d tiles left', len(unprocessed))
+            if self.fallback is not None:
+                # Left for camoperator.worker to pick up later
+                spool = SpoolQueue(self.fallback)
+                for record in unprocessed:
+                    spool.publish(dict((key, value) for key, value in record.items() if key != "id"))
+                spool.finish()
+                logging.warning('Work queue: Published the remaining tiles to spool:%s', self.fallback)
+        return unprocessed
+
+class SocketClient:
+    def __init__(self, address):
+        self.connection = Client(address)
+        self.lock = threading.Lock()
+
+    def request(self, message):
+        with self.lock:
+            self.connection.send_bytes(json.dumps(message).encode())
+            if message["type"] == "get":
+                return json.loads(self.connection.recv_bytes())
+
+    def get(self):
+        return self.request({"type": "get"})
+
+    def report(self, record, result):
+        self.request({"type": "report", "record": record, "result": result})
+
+    def close(self):
+        self.connection.close()
+
+def parse_address(spec):
+    if spec.startswith("spool:"):
+        return "spool", spec[len("spool:"):]
+    if spec.startswith("tcp://"):
+        host, port = spec[len("tcp://"):].rsplit(":", 1)
+        return "tcp", (host, int(port))
+    raise ValueError(f"Invalid work queue {spec}. Expected spool:DIRECTORY or tcp://HOST:PORT")
+
+def open_publisher(spec, reclaim_after=None, finish_timeout=None, fallback=None):
+    kind, address = parse_address(spec)
+    if kind == "tcp":
+        return SocketQueue(address, reclaim_after, finish_timeout, fallback)
+    spool = SpoolQueue(address)
+    spool.reopen()
+    return spool
+
+def open_consumer(spec, reclaim_after=None):
+    kind, address = parse_address(spec)
+    return SpoolQueue(address, reclaim_after) if kind == "spool" else SocketClient(address)
@@ -22,6 +22,12 @@ import camoperator.main
 import camoperator.camera
 import camoperator.controller
 import camoperator.calibrate
+import camoperator.daemon
+import camoperator.transcode
+import camoperator.workqueue
+import camoperator.worker
+import camoperator.storage
+import camoperator.verify
 import os
 import numpy as np
 import random
@@ -35,6 +41,8 @@ import io
 import json
 from dataclasses import dataclass
 import tempfile
+import threading
+import concurrent.futures
 import logging
 
 filename_re = re.compile("(\\d+)-(\\d+)\\.(.*)")
@@ -66,6 +74,9 @@ class BaseMockCamera:
         cv2.imwrite(destination, cv2.cvtColor(self.mock_storage[source], cv2.COLOR_RGB2BGR))
         del self.mock_storage[source]
 
+    def delete(self, source):
+        del self.mock_storage[source]
+
     def close(self):
         pass
 
@@ -175,7 +186,7 @@ class CLITest(unittest.TestCase):
         with patch("sys.argv", ['camoperator', self.example_path, '-p', 'COM4', '-X', str(self.X), '-Y', str(self.Y),
             '--min-x', str(self.min_x), '--max-x', str(self.max_x), '--min-y', str(self.min_y), '--max-y', str(self.max_y)]):
             with patch("camoperator.main.Controller", MockController):
-                with patch("camoperator.main.Camera", MockCamera):
+                with patch("camoperator.camera.Camera", MockCamera):
                     with patch("camoperator.main.get_filename", lambda directory, x, y: os.path.join(directory, f"{x}-{y}.png")):
                         camoperator.main.main()
         
@@ -226,7 +237,7 @@ class CLITest(unittest.TestCase):
             '--min-x', str(self.min_x), '--max-x', str(self.max_x), '--min-y', str(self.min_y), '--max-y', str(self.max_y),
             '--resume', f'{resume_x},{resume_y}']):
             with patch("camoperator.main.Controller", MockController):
-                with patch("camoperator.main.Camera", MockCamera):
+                with patch("camoperator.camera.Camera", MockCamera):
                     with patch("camoperator.main.get_filename", lambda directory, x, y: os.path.join(directory, f"{x}-{y}.png")):
                         camoperator.main.main()
         
@@ -256,6 +267,228 @@ class CLITest(unittest.TestCase):
         
         self.assertTrue(checked_files.all())
 
+    def test_daemon_run(self):
+        class MockController(BaseMockController):
+            def __init__(self, port):
+                super().__init__(port)
+                MockController.instance = self
+
+        class MockCamera(self.MockConfigCamera):
+            camera_height, camera_width = random.randint(400, 600), random.randint(400, 600)
+            def get_image(self):
+                shape = (MockCamera.camera_height, MockCamera.camera_width)
+                result = np.zeros((*shape, 3), dtype=np.uint8)
+                result[:, :, 0] = MockController.instance.x % 256
+                result[:, :, 1] = MockController.instance.y % 256
+                return result
+
+        address = os.path.join(tempfile.mkdtemp(), 'camoperator.sock')
+        daemon = camoperator.daemon.Daemon(address, 'COM4')
+
+        with patch("camoperator.controller.Controller", MockController):
+            with patch("camoperator.camera.Camera", MockCamera):
+                threading.Thread(target=daemon.serve_forever, daemon=True).start()
+                while not os.path.exists(address):
+                    time.sleep(0.01)
+
+                with patch("sys.argv", ['camoperator', self.example_path, '--daemon', address, '-X', str(self.X), '-Y', str(self.Y),
+                    '--min-x', str(self.min_x), '--max-x', str(self.max_x), '--min-y', str(self.min_y), '--max-y', str(self.max_y)]):
+                    with patch("camoperator.main.get_filename", lambda directory, x, y: os.path.join(directory, f"{x}-{y}.png")):
+                        camoperator.main.main()
+
+        y_positions = np.round(np.linspace(self.min_y, self.max_y, self.Y))
+        x_positions = np.round(np.linspace(self.max_x, self.min_x, self.X))
+        for x in range(self.X):
+            for y in range(self.Y):
+                np_img = cv2.cvtColor(cv2.imread(os.path.join(self.example_path, f"{x}-{y}.png")), cv2.COLOR_BGR2RGB)
+                self.assertTrue((np_img[:,:, 0] == x_positions[x] % 256).all())
+                self.assertTrue((np_img[:,:, 1] == y_positions[y] % 256).all())
+
+    def test_recapture_run(self):
+        recapture_tiles = set(random.sample([(x, y) for x in range(self.X) for y in range(self.Y)], 5))
+        plan = camoperator.verify.recapture_plan([{"x": x, "y": y} for x, y in recapture_tiles], self.X, self.Y)
+        plan_filename = os.path.join(self.example_path, 'plan.json')
+        with open(plan_filename, 'w') as plan_file:
+            json.dump(plan, plan_file)
+
+        class MockController(BaseMockController):
+            def __init__(self, port):
+                super().__init__(port)
+                MockController.instance = self
+
+        class MockCamera(self.MockConfigCamera):
+            def get_image(self):
+                result = np.zeros((100, 100, 3), dtype=np.uint8)
+                result[:, :, 0] = MockController.instance.x % 256
+                result[:, :, 1] = MockController.instance.y % 256
+                return result
+
+        with patch("sys.argv", ['camoperator', self.example_path, '-p', 'COM4', '-X', str(self.X), '-Y', str(self.Y),
+            '--min-x', str(self.min_x), '--max-x', str(self.max_x), '--min-y', str(self.min_y), '--max-y', str(self.max_y),
+            '--recapture', plan_filename]):
+            with patch("camoperator.main.Controller", MockController):
+                with patch("camoperator.camera.Camera", MockCamera):
+                    with patch("camoperator.main.get_filename", lambda directory, x, y: os.path.join(directory, f"{x}-{y}.png")):
+                        camoperator.main.main()
+
+        y_positions = np.round(np.linspace(self.min_y, self.max_y, self.Y))
+        x_positions = np.round(np.linspace(self.max_x, self.min_x, self.X))
+        captured = set()
+        for filename in os.listdir(self.example_path):
+            match = filename_re.match(filename)
+            if match and match.group(3) == 'png':
+                x, y = int(match.group(1)), int(match.group(2))
+                captured.add((x, y))
+                np_img = cv2.cvtColor(cv2.imread(os.path.join(self.example_path, filename)), cv2.COLOR_BGR2RGB)
+                self.assertTrue((np_img[:,:, 0] == x_positions[x] % 256).all())
+                self.assertTrue((np_img[:,:, 1] == y_positions[y] % 256).all())
+        self.assertEqual(captured, recapture_tiles)
+
+    def test_daemon_serializes_devices(self):
+        class MockController(BaseMockController):
+            active = 0
+            overlapped = False
+
+            def move_x(self, dx):
+                MockController.active += 1
+                MockController.overlapped |= MockController.active > 1
+                time.sleep(0.001)
+                MockController.active -= 1
+
+        address = os.path.join(tempfile.mkdtemp(), 'camoperator.sock')
+        daemon = camoperator.daemon.Daemon(address, 'COM4')
+
+        with patch("camoperator.controller.Controller", MockController):
+            threading.Thread(target=daemon.serve_forever, daemon=True).start()
+            while not os.path.exists(address):
+                time.sleep(0.01)
+
+            def move(controller):
+                for _ in range(50):
+                    controller.call('move_x', 1)
+
+            clients = [camoperator.daemon.RemoteController(address) for _ in range(3)]
+            threads = [threading.Thread(target=move, args=(client,)) for client in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for client in clients:
+                client.close()
+
+        self.assertFalse(MockController.overlapped)
+
+    def test_daemon_recovers_devices(self):
+        class MockController(BaseMockController):
+            instances = 0
+
+            def __init__(self, port):
+                super().__init__(port)
+                MockController.instances += 1
+                self.failing = MockController.instances == 1
+
+            def move_x(self, dx):
+                if self.failing:
+                    raise OSError('Controller unplugged')
+
+        address = os.path.join(tempfile.mkdtemp(), 'camoperator.sock')
+        daemon = camoperator.daemon.Daemon(address, 'COM4')
+
+        with patch("camoperator.controller.Controller", MockController):
+            threading.Thread(target=daemon.serve_forever, daemon=True).start()
+            while not os.path.exists(address):
+                time.sleep(0.01)
+
+            controller = camoperator.daemon.RemoteController(address)
+            with self.assertRaises(RuntimeError):
+                controller.move_x(1)
+            # The failed controller is dropped and opened again on the next call
+            controller.call('move_x', 1)
+            controller.close()
+
+        self.assertEqual(MockController.instances, 2)
+
+    def test_daemon_deletes_orphans(self):
+        class MockCamera(BaseMockCamera):
+            deleted = []
+
+            def get_image(self):
+                return np.zeros((4, 4, 3), dtype=np.uint8)
+
+            def delete(self, source):
+                super().delete(source)
+                MockCamera.deleted.append(source.name)
+
+        address = os.path.join(tempfile.mkdtemp(), 'camoperator.sock')
+        daemon = camoperator.daemon.Daemon(address)
+
+        with patch("camoperator.camera.Camera", MockCamera):
+            threading.Thread(target=daemon.serve_forever, daemon=True).start()
+            while not os.path.exists(address):
+                time.sleep(0.01)
+
+            camera = camoperator.daemon.RemoteCamera(address)
+            downloaded = camera.capture()
+            orphan = camera.capture()
+            camera.download(downloaded, os.path.join(tempfile.mkdtemp(), 'image.png'))
+            camera.close()
+
+            for _ in range(500):
+                if MockCamera.deleted:
+                    break
+                time.sleep(0.01)
+
+        self.assertEqual(MockCamera.deleted, [orphan.name])
+        self.assertEqual(daemon.captured, {})
+
+    def test_daemon_rejects_shared_directory(self):
+        directory = tempfile.mkdtemp()
+        os.chmod(directory, 0o777)
+        address = os.path.join(directory, 'camoperator.sock')
+        with self.assertRaises(RuntimeError):
+            camoperator.daemon.Daemon(address).serve_forever()
+        with self.assertRaises(RuntimeError):
+            camoperator.daemon.RemoteController(address)
+        shutil.rmtree(directory)
+
+class CameraConfigTest(unittest.TestCase):
+    class MockWidget:
+        def __init__(self, value):
+            self.value = value
+
+        def get_value(self):
+            return self.value
+
+        def set_value(self, value):
+            self.value = value
+
+    def test_only_changed_widgets_written(self):
+        widgets = {
+            "imagequality": self.MockWidget("NEF (Raw)"),
+            "autofocus": self.MockWidget("On"),
+            "capturemode": self.MockWidget("Single Shot"),
+            "iso": self.MockWidget("100")
+        }
+        written = []
+
+        class MockGPCamera:
+            def init(self):
+                pass
+
+            def get_single_config(self, key):
+                return widgets[key]
+
+            def set_single_config(self, key, widget):
+                written.append(key)
+
+        with patch("camoperator.camera.gp.Camera", MockGPCamera):
+            camera = camoperator.camera.Camera({"iso": 100})
+            self.assertEqual(written, ["autofocus"])
+            self.assertEqual(widgets["autofocus"].get_value(), "Off")
+
+            camera.configure({"iso": 200})
+            self.assertEqual(written, ["autofocus", "iso"])
+
 class CalibrateCLITest(unittest.TestCase):
     def test_empty(self):
         with self.assertRaises(SystemExit):
@@ -284,8 +517,8 @@ class CalibrateCLITest(unittest.TestCase):
 
         with patch('sys.argv', ['calibrate', '--checkerboard-dims', '8,6', '-p', 'COM4']):
             with patch('sys.stdout', output_capture):
-                with patch("camoperator.calibrate.Controller", MockController):
-                    with patch("camoperator.calibrate.Camera", MockCamera):
+                with patch("camoperator.controller.Controller", MockController):
+                    with patch("camoperator.camera.Camera", MockCamera):
                         camoperator.calibrate.main()
         
         output_capture.seek(0)
@@ -297,3 +530,422 @@ class CalibrateCLITest(unittest.TestCase):
         self.assertIn("shutterspeed", config)
 
             
+
+class TranscodeTest(unittest.TestCase):
+    def setUp(self):
+        self.example_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.example_path)
+
+    def test_transcode(self):
+        with rawpy.imread('test/checkerboard.nef') as raw_img:
+            raw_image = raw_img.raw_image.copy()
+
+        for format in camoperator.transcode.formats:
+            filename = os.path.join(self.example_path, f'{format}.nef')
+            shutil.copyfile('test/checkerboard.nef', filename)
+
+            transcoder = camoperator.transcode.Transcoder(format, 2)
+            transcoder.submit(filename)
+            self.assertEqual(transcoder.close(), [])
+
+            self.assertFalse(os.path.exists(filename))
+            output = os.path.join(self.example_path, f'{format}.{format}')
+            if format == 'npz':
+                with np.load(output) as archive:
+                    self.assertTrue(np.array_equal(archive['raw_image'], raw_image))
+                    sizes = json.loads(archive['sizes'].tobytes())
+                    exif = json.loads(archive['exif'].tobytes())
+            else:
+                self.assertTrue(np.array_equal(cv2.imread(output, cv2.IMREAD_UNCHANGED), raw_image))
+                with open(f'{output}.json') as sidecar_file:
+                    sidecar = json.load(sidecar_file)
+                for key in ["black_level_per_channel", "white_level", "raw_pattern", "color_desc", "camera_whitebalance",
+                    "daylight_whitebalance", "rgb_xyz_matrix", "color_matrix", "tone_curve"]:
+                    self.assertIn(key, sidecar)
+                sizes, exif = sidecar['sizes'], sidecar['exif']
+            self.assertEqual((sizes['raw_height'], sizes['raw_width']), raw_image.shape)
+            self.assertIn('flip', sizes)
+            self.assertEqual(exif['Image Make']['printable'], 'NIKON CORPORATION')
+
+    def test_failure_keeps_original(self):
+        filename = os.path.join(self.example_path, 'invalid.nef')
+        with open(filename, 'wb') as invalid_file:
+            invalid_file.write(b'not a raw file')
+
+        transcoder = camoperator.transcode.Transcoder('npz', 1)
+        transcoder.submit(filename)
+        failures = transcoder.close()
+        self.assertEqual([failed for failed, _ in failures], [filename])
+        self.assertTrue(os.path.exists(filename))
+
+    def test_callback_outside_lock(self):
+        transcoder = camoperator.transcode.Transcoder('npz', 1)
+        transcoder.running = 1
+        future = concurrent.futures.Future()
+        future.set_result('0-0.npz')
+
+        # A callback that takes long, e.g. publishing to a slow queue, does not hold up capture
+        reported = []
+        def callback(output):
+            thread = threading.Thread(target=lambda: reported.append(transcoder.report_wait(0) or output))
+            thread.start()
+            thread.join(5)
+
+        transcoder.done('0-0.nef', callback, future)
+        self.assertEqual(reported, ['0-0.npz'])
+        self.assertEqual(transcoder.running, 0)
+        transcoder.close()
+
+    def test_adapts_workers(self):
+        transcoder = camoperator.transcode.Transcoder('npz', 4)
+        samples = transcoder.samples
+
+        # Slow downloads the rig always has are the baseline, not a stall
+        for _ in range(samples*2):
+            transcoder.report_wait(1)
+        self.assertEqual(transcoder.baseline, 1)
+        self.assertEqual(transcoder.workers, 1)
+
+        # Grows while there is a backlog and capture keeps up
+        # Keep every worker busy so the backlog is never dispatched
+        transcoder.running = transcoder.max_workers
+        transcoder.pending.append(('backlog.nef', None))
+        for _ in range(samples*3):
+            transcoder.report_wait(1)
+        self.assertEqual(transcoder.workers, 4)
+
+        # Halves once the average wait grows over the baseline
+        for _ in range(samples*2):
+            transcoder.report_wait(2)
+            if transcoder.workers != 4:
+                break
+        self.assertEqual(transcoder.workers, 2)
+
+        transcoder.pending.clear()
+        transcoder.running = 0
+        transcoder.close()
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.example_path = tempfile.mkdtemp()
+        self.records = [
+            {"x": x, "y": y, "filename": os.path.join(self.example_path, f"{x}-{y}.nef")}
+            for y in range(3) for x in range(3)
+        ]
+        self.command = f'python -c "open(\'{self.example_path}/{{x}}-{{y}}.done\', \'w\')"'
+
+    def tearDown(self):
+        shutil.rmtree(self.example_path)
+
+    def check_processed(self):
+        for record in self.records:
+            self.assertTrue(os.path.exists(os.path.join(self.example_path, f"{record['x']}-{record['y']}.done")))
+
+    def test_spool(self):
+        spool = os.path.join(self.example_path, 'spool')
+        queue = camoperator.workqueue.open_publisher(f'spool:{spool}')
+        for record in self.records:
+            queue.publish(record)
+        queue.finish()
+
+        jobs = [threading.Thread(target=camoperator.worker.consume, args=(f'spool:{spool}', self.command)) for _ in range(3)]
+        for job in jobs:
+            job.start()
+        for job in jobs:
+            job.join()
+
+        self.check_processed()
+        self.assertEqual(len(os.listdir(os.path.join(spool, 'done'))), len(self.records))
+        self.assertEqual(os.listdir(os.path.join(spool, 'ready')), [])
+        self.assertEqual(os.listdir(os.path.join(spool, 'claimed')), [])
+
+    def test_socket(self):
+        queue = camoperator.workqueue.open_publisher('tcp://127.0.0.1:0')
+        host, port = queue.listener.address
+        jobs = [threading.Thread(target=camoperator.worker.consume, args=(f'tcp://{host}:{port}', self.command)) for _ in range(3)]
+        for job in jobs:
+            job.start()
+
+        for record in self.records:
+            queue.publish(record)
+        queue.finish()
+        for job in jobs:
+            job.join()
+
+        self.check_processed()
+
+    def test_socket_requeue(self):
+        queue = camoperator.workqueue.open_publisher('tcp://127.0.0.1:0')
+        host, port = queue.listener.address
+        queue.publish(self.records[0])
+
+        # A worker that disappears without reporting
+        client = camoperator.workqueue.open_consumer(f'tcp://{host}:{port}')
+        self.assertEqual(client.get()["filename"], self.records[0]["filename"])
+        client.close()
+
+        self.records = self.records[:1]
+        job = threading.Thread(target=camoperator.worker.consume, args=(f'tcp://{host}:{port}', self.command))
+        job.start()
+        queue.finish()
+        job.join()
+        self.check_processed()
+
+    def test_socket_reclaim(self):
+        queue = camoperator.workqueue.open_publisher('tcp://127.0.0.1:0', reclaim_after=0.2)
+        host, port = queue.listener.address
+        queue.publish(self.records[0])
+
+        # A worker that stays connected but never reports
+        hung = camoperator.workqueue.open_consumer(f'tcp://{host}:{port}')
+        self.assertEqual(hung.get()["filename"], self.records[0]["filename"])
+
+        self.records = self.records[:1]
+        job = threading.Thread(target=camoperator.worker.consume, args=(f'tcp://{host}:{port}', self.command))
+        job.start()
+        self.assertEqual(queue.finish(), [])
+        job.join()
+        hung.close()
+        self.check_processed()
+
+    def test_socket_finish_timeout(self):
+        fallback = os.path.join(self.example_path, 'unprocessed')
+        queue = camoperator.workqueue.open_publisher('tcp://127.0.0.1:0', finish_timeout=0.2, fallback=fallback)
+        for record in self.records:
+            queue.publish(record)
+
+        # No worker ever connects
+        self.assertEqual(len(queue.finish()), len(self.records))
+        self.assertEqual(len(os.listdir(os.path.join(fallback, 'ready'))), len(self.records))
+
+        camoperator.worker.consume(f'spool:{fallback}', self.command)
+        self.check_processed()
+
+    def test_spool_missing_command(self):
+        spool = os.path.join(self.example_path, 'spool')
+        queue = camoperator.workqueue.open_publisher(f'spool:{spool}')
+        for record in self.records:
+            queue.publish(record)
+        queue.finish()
+
+        camoperator.worker.consume(f'spool:{spool}', 'camoperator-missing-command {filename}')
+
+        failed = os.listdir(os.path.join(spool, 'failed'))
+        self.assertEqual(len(failed), len(self.records))
+        self.assertEqual(os.listdir(os.path.join(spool, 'claimed')), [])
+        with open(os.path.join(spool, 'failed', failed[0])) as record_file:
+            self.assertNotEqual(json.load(record_file)['result']['returncode'], 0)
+
+    def test_socket_missing_command(self):
+        queue = camoperator.workqueue.open_publisher('tcp://127.0.0.1:0')
+        host, port = queue.listener.address
+        job = threading.Thread(target=camoperator.worker.consume, args=(f'tcp://{host}:{port}', 'camoperator-missing-command'))
+        job.start()
+
+        for record in self.records:
+            queue.publish(record)
+        # Returns once every record has been reported, even as failed
+        queue.finish()
+        job.join()
+
+    def test_spool_reclaim(self):
+        spool = os.path.join(self.example_path, 'spool')
+        queue = camoperator.workqueue.open_publisher(f'spool:{spool}')
+        queue.publish(self.records[0])
+        queue.finish()
+
+        # A worker that disappears without reporting
+        self.assertEqual(camoperator.workqueue.open_consumer(f'spool:{spool}').get()["filename"], self.records[0]["filename"])
+        self.assertIsNone(camoperator.workqueue.open_consumer(f'spool:{spool}', 3600).get())
+
+        self.records = self.records[:1]
+        camoperator.worker.consume(f'spool:{spool}', self.command, 0)
+        self.check_processed()
+        self.assertEqual(len(os.listdir(os.path.join(spool, 'done'))), 1)
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self.example_path = tempfile.mkdtemp()
+        self.directories = [os.path.join(self.example_path, str(i)) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.example_path)
+
+    def write_tile(self, storage, x, y):
+        filename = os.path.join(storage.directory_for(x, y), f"{x}-{y}.nef")
+        with open(filename, 'wb') as tile_file:
+            tile_file.write(b'0' * 1024)
+        storage.tile_written(x, y, filename)
+        return os.path.dirname(filename)
+
+    def test_preflight(self):
+        storage = camoperator.storage.Storage(self.directories, tile_size=1024)
+        storage.preflight(10)
+        self.assertTrue(storage.checked)
+
+        storage = camoperator.storage.Storage(self.directories, tile_size=shutil.disk_usage(self.example_path).free)
+        with self.assertRaises(RuntimeError):
+            storage.preflight(2)
+
+    def test_preflight_not_strict(self):
+        storage = camoperator.storage.Storage(self.directories, tile_size=shutil.disk_usage(self.example_path).free, strict=False)
+        with self.assertLogs(level='WARNING'):
+            storage.preflight(2)
+        self.assertTrue(storage.checked)
+
+    def test_preflight_before_homing(self):
+        class MockController(BaseMockController):
+            instances = 0
+            def __init__(self, port):
+                super().__init__(port)
+                MockController.instances += 1
+
+        free_mb = shutil.disk_usage(self.example_path).free // (1024*1024)
+        with patch("sys.argv", ['camoperator', self.directories[0], '-p', 'COM4', '-X', '2', '-Y', '2',
+            '--tile-size', str(free_mb)]):
+            with patch("camoperator.main.Controller", MockController):
+                with self.assertRaises(RuntimeError):
+                    camoperator.main.main()
+        self.assertEqual(MockController.instances, 0)
+
+    def test_tile_size_from_existing(self):
+        os.makedirs(self.directories[0])
+        with open(os.path.join(self.directories[0], '1-2.nef'), 'wb') as tile_file:
+            tile_file.write(b'0' * 2048)
+        with open(os.path.join(self.directories[0], 'config.json'), 'wb') as config_file:
+            config_file.write(b'0' * 4096)
+        self.assertEqual(camoperator.storage.Storage(self.directories).tile_size, 2048)
+
+    def test_stripe(self):
+        storage = camoperator.storage.Storage(self.directories, 'stripe')
+        written = [self.write_tile(storage, x, 0) for x in range(6)]
+        self.assertEqual(written, self.directories * 2)
+
+        tile_map = camoperator.storage.read_tile_map(self.directories[0])
+        self.assertEqual(tile_map, dict(((x, 0), os.path.abspath(directory)) for x, directory in enumerate(written)))
+
+    def test_spill(self):
+        storage = camoperator.storage.Storage(self.directories, 'spill')
+        full = set([self.directories[0]])
+        with patch.object(storage, 'has_room', lambda directory: directory not in full):
+            self.assertEqual(self.write_tile(storage, 0, 0), self.directories[1])
+            self.assertEqual(self.write_tile(storage, 1, 0), self.directories[1])
+            full.add(self.directories[1])
+            self.assertEqual(self.write_tile(storage, 2, 0), self.directories[2])
+
+    def test_tile_map_kept_up(self):
+        main_directory, extra_directory = self.directories[:2]
+        self.write_tile(camoperator.storage.Storage([main_directory]), 0, 0)
+        self.assertFalse(os.path.exists(os.path.join(main_directory, 'tiles.jsonl')))
+
+        # Saved to an extra directory by an earlier run, then recaptured into the main directory alone
+        with open(os.path.join(main_directory, 'tiles.jsonl'), 'w') as tile_map_file:
+            tile_map_file.write(json.dumps({"x": 1, "y": 1, "directory": os.path.abspath(extra_directory)}) + '\n')
+        self.write_tile(camoperator.storage.Storage([main_directory]), 1, 1)
+        self.assertEqual(camoperator.storage.read_tile_map(main_directory), {(1, 1): os.path.abspath(main_directory)})
+
+    def test_pause(self):
+        storage = camoperator.storage.Storage(self.directories)
+        storage.check_interval = 0
+        full = set(self.directories)
+        pauses = []
+        def on_pause():
+            pauses.append(True)
+            if len(pauses) == 3:
+                full.clear()
+
+        with patch.object(storage, 'has_room', lambda directory: directory not in full):
+            self.assertEqual(storage.directory_for(0, 0, on_pause), self.directories[0])
+        self.assertEqual(len(pauses), 3)
+
+    def test_in_flight(self):
+        running = [0]
+        storage = camoperator.storage.Storage(self.directories, tile_size=1024, in_flight=lambda: running[0])
+        with patch.object(storage, 'available', lambda directory: 3000):
+            self.assertTrue(storage.has_room(self.directories[0]))
+            # Each running transcode writes a copy of its image before removing the original
+            running[0] = 2
+            self.assertFalse(storage.has_room(self.directories[0]))
+
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.example_path = tempfile.mkdtemp()
+        self.X, self.Y = 4, 3
+        for x in range(self.X):
+            for y in range(self.Y):
+                self.write_tile(x, y, b'II*\x00' + b'0' * 1020)
+
+    def tearDown(self):
+        shutil.rmtree(self.example_path)
+
+    def write_tile(self, x, y, data, directory=None):
+        with open(os.path.join(directory or self.example_path, f'{x}-{y}.nef'), 'wb') as tile_file:
+            tile_file.write(data)
+
+    def test_clean(self):
+        self.assertEqual(list(camoperator.verify.verify([self.example_path], self.X, self.Y)), [])
+
+    def test_problems(self):
+        os.remove(os.path.join(self.example_path, '1-1.nef'))
+        self.write_tile(2, 0, b'II*\x00')
+        self.write_tile(0, 2, b'JPEG' + b'0' * 1020)
+
+        problems = list(camoperator.verify.verify([self.example_path], self.X, self.Y, jobs=2))
+        self.assertEqual(
+            sorted((problem["x"], problem["y"], problem["status"]) for problem in problems),
+            [(0, 2, "invalid"), (1, 1, "missing"), (2, 0, "small")]
+        )
+
+        plan = camoperator.verify.recapture_plan(problems, self.X, self.Y)
+        # Capture starts at the right of even rows and the left of odd rows
+        self.assertEqual(plan["tiles"], [[2, 0], [1, 1], [0, 2]])
+        self.assertEqual(plan["resume"], [2, 0])
+
+    def test_latest_copy(self):
+        extra_directory = tempfile.mkdtemp()
+        # (1, 1) was bad in the main directory and recaptured into the extra one
+        self.write_tile(1, 1, b'JPEG' + b'0' * 1020)
+        self.write_tile(1, 1, b'II*\x00' + b'0' * 1020, extra_directory)
+        # (2, 2) is recorded in the extra directory, which lacks it
+        tile_map = {(1, 1): extra_directory, (2, 2): extra_directory}
+
+        problems = list(camoperator.verify.verify([self.example_path, extra_directory], self.X, self.Y, tile_map=tile_map))
+        shutil.rmtree(extra_directory)
+        self.assertEqual(problems, [{"x": 2, "y": 2, "status": "missing"}])
+
+    def test_newest_file(self):
+        # A bad transcoded copy left next to a good recaptured original
+        self.write_tile(3, 2, b'JPEG' + b'0' * 1020)
+        os.rename(os.path.join(self.example_path, '3-2.nef'), os.path.join(self.example_path, '3-2.npz'))
+        os.utime(os.path.join(self.example_path, '3-2.npz'), (0, 0))
+        self.write_tile(3, 2, b'II*\x00' + b'0' * 1020)
+        self.assertEqual(list(camoperator.verify.verify([self.example_path], self.X, self.Y, min_size=1)), [])
+
+        # Unless the bad copy is the newer one
+        os.utime(os.path.join(self.example_path, '3-2.nef'), (0, 0))
+        os.utime(os.path.join(self.example_path, '3-2.npz'))
+        problems = list(camoperator.verify.verify([self.example_path], self.X, self.Y, min_size=1))
+        self.assertEqual([(problem["x"], problem["y"], problem["status"]) for problem in problems], [(3, 2, "invalid")])
+
+    def test_cli(self):
+        extra_directory = tempfile.mkdtemp()
+        os.remove(os.path.join(self.example_path, '3-2.nef'))
+        self.write_tile(3, 2, b'II*\x00' + b'0' * 1020, extra_directory)
+        with open(os.path.join(self.example_path, 'tiles.jsonl'), 'w') as tile_map_file:
+            tile_map_file.write(json.dumps({"x": 3, "y": 2, "directory": extra_directory}) + '\n')
+        os.remove(os.path.join(self.example_path, '0-0.nef'))
+
+        output_capture = io.StringIO()
+        plan_filename = os.path.join(self.example_path, 'plan.json')
+        with patch('sys.argv', ['verify', self.example_path, '-X', str(self.X), '-Y', str(self.Y), '--plan', plan_filename]):
+            with patch('sys.stdout', output_capture):
+                with self.assertRaises(SystemExit):
+                    camoperator.verify.main()
+        shutil.rmtree(extra_directory)
+
+        problems = [json.loads(line) for line in output_capture.getvalue().splitlines()]
+        self.assertEqual(problems, [{"x": 0, "y": 0, "status": "missing"}])
+        with open(plan_filename) as plan_file:
+            self.assertEqual(json.load(plan_file)["tiles"], [[0, 0]])